@@ -5,97 +5,608 @@ Universal PDF → Excel (editable tables) for Relay
 - Vrátí XLSX, kde je každá nalezená tabulka v editovatelných buňkách.
 - Na stránce ponechá JEDNU (největší) tabulku, aby nevznikaly duplikáty.
 - Funguje bez OCR (textová PDF). OCR můžeme doplnit později přes Docker.
+- PDF čte přes PyMuPDF; PDF_BACKEND=pdfplumber vrátí původní (pomalejší) parser.
+- Zaseklé stránky přeskočí po PAGE_TIMEOUT sekundách (výchozí 10).
+- Odmítne PDF větší než MAX_PDF_BYTES (výchozí 50 MB) nebo s víc než MAX_PAGES stránkami (500).
 
 Endpointy:
 - POST /pdf_to_struct_xlsx            … nahraný PDF soubor (multipart)
 - POST /pdf_from_url_to_struct_xlsx   … URL na PDF (server si PDF stáhne sám)
 """
 
-import io, re, os, unicodedata
-from typing import List, Tuple
+import io, re, os, asyncio, hashlib, logging, multiprocessing, signal, tempfile, threading, unicodedata
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from itertools import repeat
+from typing import List, Optional, Tuple, Union
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse
+from starlette.background import BackgroundTask
 import pdfplumber
-import pandas as pd
-from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
-import requests  # pro endpoint s URL
-
-app = FastAPI(title="Universal PDF→Excel (tables)")
+import pymupdf  # PyMuPDF (dříve "fitz")
+from wolfxl import Workbook  # Rust drop-in za openpyxl.Workbook
+import httpx  # pro endpoint s URL (async, neblokuje event loop)
+
+# jeden klient pro celou aplikaci → sdílený connection pool. Vzniká až v lifespan:
+# workery poolu (spawn) modul app znovu importují a klienta ani pool mít nemají.
+HTTP: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global HTTP
+    HTTP = httpx.AsyncClient(timeout=30, follow_redirects=True)
+    try:
+        yield
+    finally:
+        await HTTP.aclose()
+        shutdown_pool()
+
+app = FastAPI(title="Universal PDF→Excel (tables)", lifespan=lifespan)
+logger = logging.getLogger(__name__)
+
+# "pymupdf" (výchozí, rychlý) nebo "pdfplumber" (záloha pro okrajové případy)
+PDF_BACKEND = os.environ.get("PDF_BACKEND", "pymupdf").strip().lower()
+# max. doba parsování jedné stránky v sekundách (0 = bez limitu)
+PAGE_TIMEOUT = float(os.environ.get("PAGE_TIMEOUT", 10))
+# horní meze vstupu: jedno obří PDF nesmí na minuty zablokovat workery
+MAX_PDF_BYTES = int(os.environ.get("MAX_PDF_BYTES", 50 * 1024 * 1024))
+MAX_PAGES = int(os.environ.get("MAX_PAGES", 500))
 
 # -------- helpers --------
 def nz(x):
     return "" if x is None else str(x)
 
+def save_xlsx_tempfile(wb) -> str:
+    """
+    Uloží workbook do dočasného .xlsx a vrátí cestu; soubor pošle FileResponse
+    (sendfile, bez kopie v RAM) a smaže ho BackgroundTask po odeslání.
+    """
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        wb.save(path)
+    except Exception:
+        os.unlink(path)
+        raise
+    finally:
+        wb.close()  # uvolní nativní workbook hned, ve vlákně, kde vznikl
+    return path
+
+WS_RX = re.compile(r"\s+")
+
+# česká a slovenská diakritika → ASCII jedním str.translate (bez NFKD + encode/decode)
+DIACRITIC_MAP = str.maketrans({
+    c: unicodedata.normalize("NFKD", c).encode("ascii", "ignore").decode("ascii")
+    for c in "áčďéěíňóřšťúůýžÁČĎÉĚÍŇÓŘŠŤÚŮÝŽäľĺŕôÄĽĹŔÔ"
+})
+
+# hlavičky ("Běžné období", "Minulé období", …) se opakují napříč stránkami
+@lru_cache(maxsize=4096)
 def norm_text(s: str) -> str:
-    s = unicodedata.normalize("NFKD", s)
-    s = s.encode("ascii", "ignore").decode("ascii")
-    s = re.sub(r"\s+", " ", s).strip()
+    s = s.translate(DIACRITIC_MAP)
+    if not s.isascii():  # jiné znaky než česká diakritika → obecná cesta
+        s = unicodedata.normalize("NFKD", s)
+        s = s.encode("ascii", "ignore").decode("ascii")
+    s = WS_RX.sub(" ", s).strip()
     return s
 
 # čísla typu 12 345 nebo (1 234)
 NUM_RX = re.compile(r"\(?-?\d+(?:\s\d{3})*\)?")
+ALPHA_RX = re.compile(r"[A-Za-z]")
+DIGIT_RX = re.compile(r"\d")
+# sdílený odkaz na Google Drive → ID souboru
+GDRIVE_RX = re.compile(r"https?://drive\.google\.com/file/d/([^/]+)/")
+
+def looks_like_header(row: List[str]) -> bool:
+    """První řádek je hlavička, když má písmena a za popiskem nejsou jen čísla."""
+    # any()/all() končí u první rozhodující buňky; buňky Table jsou vždy str
+    return any(ALPHA_RX.search(x) for x in row) and not all(NUM_RX.fullmatch(x) for x in row[1:])
 
 # -------- extraction (bez OCR) --------
-def extract_tables_pdfplumber(pdf_bytes: bytes, min_cols: int) -> List[pd.DataFrame]:
+# PDF jako bytes (stažené z URL) nebo cesta k souboru na disku (upload)
+PdfSource = Union[bytes, str]
+# tabulka = seznam řádků, všechny stejně široké, buňky jsou vždy str
+Table = List[List[str]]
+# výsledek jedné stránky: (tabulka nebo None, přeskočena kvůli PAGE_TIMEOUT?)
+PageResult = Tuple[Optional[Table], bool]
+# výsledek celého PDF: (tabulky, čísla přeskočených stránek od 1)
+Extracted = Tuple[List[Table], List[int]]
+
+def open_pdfplumber(src: PdfSource, **kwargs):
+    return pdfplumber.open(io.BytesIO(src) if isinstance(src, bytes) else src, **kwargs)
+
+def open_pymupdf(src: PdfSource):
+    # z cesty čte PyMuPDF stránky až na vyžádání, celé PDF nedrží v paměti
+    if isinstance(src, bytes):
+        return pymupdf.open(stream=src, filetype="pdf")
+    return pymupdf.open(src, filetype="pdf")
+
+def table_from_rows(raw_rows, min_cols: int) -> Optional[Table]:
+    """Buňky → stringy, doplní řádky na stejnou šířku, vrátí None pro malé tabulky."""
+    rows = [[nz(c) for c in (trow or [])] for trow in raw_rows or []]
+    if not rows:
+        return None
+    width = max(map(len, rows))
+    if width < min_cols or len(rows) < 2:
+        return None
+    # řádky jsou čerstvé seznamy → krátké stačí dolít na místě, bez kopie celé tabulky
+    for r in rows:
+        if len(r) < width:
+            r.extend([""] * (width - len(r)))
+    return rows
+
+def split_tail_numbers(ln: str) -> Tuple[str, List[str]]:
+    """
+    Rozdělí řádek na popisek a čísla na jeho konci (zápis jako NUM_RX: 12 345,
+    (1 234), -5), jedním průchodem odzadu bez regexu:
+    "Tržby 12 345 (678)" → ("Tržby", ["12 345", "(678)"]); bez čísel → (..., []).
+    Číslo musí od popisku i od dalšího čísla oddělovat mezera.
+    """
+    tokens: List[str] = []
+    i = len(ln)
+    while True:
+        end = i
+        while end > 0 and ln[end - 1].isspace():
+            end -= 1
+        j = end
+        if j > 0 and ln[j - 1] == ")":
+            j -= 1
+        # skupiny číslic odzadu; 3 číslice za jednou mezerou = tisíce téhož čísla
+        second = None  # začátek 2. skupiny zleva (pro rozpojení, viz níže)
+        while True:
+            k = j
+            while k > 0 and ln[k - 1].isdecimal():
+                k -= 1
+            if j - k == 3 and k >= 2 and ln[k - 1].isspace() and ln[k - 2].isdecimal():
+                second = k
+                j = k - 1
+                continue
+            break
+        if k == j:
+            break
+        start = k
+        if start > 0 and ln[start - 1] == "-":
+            start -= 1
+        if start > 0 and ln[start - 1] == "(":
+            start -= 1
+        if start == 0 or not ln[start - 1].isspace():
+            # "2 245" na začátku řádku: první skupina patří k popisku, zbytek je číslo
+            if second is not None:
+                tokens.append(ln[second:end])
+                i = second
+            break
+        tokens.append(ln[start:end])
+        i = start
+    tokens.reverse()
+    return ln[:i].strip(), tokens
+
+def table_from_text(txt: str, min_cols: int) -> Optional[Table]:
+    """
+    Fallback z textu stránky: řádky "popisek … číslo číslo" → [popisek, čísla...].
+    """
+    # stránka bez jediné číslice (titulní list, text zprávy) žádný řádek nedá
+    if not txt or not DIGIT_RX.search(txt):
+        return None
+    lines = [l for l in txt.splitlines() if l.strip()]
+    rec = []
+    for ln in lines:
+        label, values = split_tail_numbers(ln)
+        if values:
+            rec.append([label, *values])
+    return table_from_rows(rec, min_cols)
+
+# slova bližší než LINE_TOL (pt) ve svislém směru jsou na stejném řádku;
+# svislá mezera, kterou neprotne žádné slovo a je širší než COL_GAP_EM × výška
+# písma, odděluje sloupce (mezera mezi slovy / tisíci je cca 0.25 em)
+LINE_TOL = 3
+COL_GAP_EM = 1.0
+
+# pdfplumber: tabulky jen podle čar (výkazy mají mřížku), bez textové heuristiky;
+# odpovídá výchozímu nastavení, ale je explicitní pro guard na p.edges níže
+TABLE_SETTINGS = {
+    "vertical_strategy": "lines",
+    "horizontal_strategy": "lines",
+    "snap_tolerance": 3,
+    "intersection_tolerance": 3,
+}
+
+def table_from_words(words, min_cols: int) -> Optional[Table]:
+    """
+    Levná rekonstrukce tabulky z page.extract_words() bez layout analýzy:
+    řádky podle `top`, sloupce podle svislých mezer mezi slovy.
+    Vrátí None, pokud nevyjdou aspoň 2 sloupce.
+    """
+    if not words:
+        return None
+
+    # sloupce: sliju x-rozsahy všech slov, co zbyde mezi nimi, jsou hranice
+    heights = sorted(w["bottom"] - w["top"] for w in words)
+    gap = COL_GAP_EM * heights[len(heights) // 2]
+    cols: List[List[float]] = []
+    for x0, x1 in sorted((w["x0"], w["x1"]) for w in words):
+        if cols and x0 <= cols[-1][1] + gap:
+            cols[-1][1] = max(cols[-1][1], x1)
+        else:
+            cols.append([x0, x1])
+    if len(cols) < 2:
+        return None
+    starts = [c[0] for c in cols]
+
+    # řádky: slova seřazená shora, nový řádek při skoku > LINE_TOL
+    lines: List[list] = []
+    for w in sorted(words, key=lambda w: (w["top"], w["x0"])):
+        if lines and w["top"] - lines[-1][0]["top"] <= LINE_TOL:
+            lines[-1].append(w)
+        else:
+            lines.append([w])
+
+    rows = []
+    for line in lines:
+        row = [""] * len(cols)
+        for w in sorted(line, key=lambda w: w["x0"]):
+            j = bisect_right(starts, w["x0"]) - 1
+            row[j] = f"{row[j]} {w['text']}" if row[j] else w["text"]
+        # víc čísel v jedné buňce = sloupce nejsou zarovnané, heuristika nesedí
+        if any(len(NUM_RX.findall(c)) > 1 for c in row[1:]):
+            return None
+        rows.append(row)
+    return table_from_rows(rows, min_cols)
+
+def page_table_pdfplumber(p, min_cols: int) -> Optional[Table]:
+    """Největší tabulka z jedné pdfplumber stránky (nebo None)."""
+    page_tables: List[Table] = []
+
+    # 1) tabulky podle čar; strategie "lines" bez čar/obdélníků na stránce nic
+    #    nenajde, takže se spouští jen když nějaké jsou
+    if p.edges:
+        for t in p.extract_tables(table_settings=TABLE_SETTINGS) or []:
+            tbl = table_from_rows(t, min_cols)
+            if tbl is not None:
+                page_tables.append(tbl)
+
+    # 2) neorámovaná tabulka ze slov (rychlé); bere všechna slova stránky
+    #    včetně titulku, proto až když mřížka nic nedala
+    words = p.extract_words(use_text_flow=False, keep_blank_chars=False)
+    if not page_tables:
+        tbl = table_from_words(words, min_cols)
+        if tbl is not None:
+            page_tables.append(tbl)
+
+    # 3) fallback z textu POUZE pokud nic nenašli; bez číslic ve slovech
+    #    nemá smysl ani skládat text stránky
+    if not page_tables and any(DIGIT_RX.search(w["text"]) for w in words):
+        tbl = table_from_text(p.extract_text() or "", min_cols)
+        if tbl is not None:
+            page_tables.append(tbl)
+
+    # 4) ze stránky vyber největší tabulku
+    if page_tables:
+        return max(page_tables, key=lambda t: len(t) * len(t[0]))
+    return None
+
+def page_text_pymupdf(p) -> str:
+    """
+    Text stránky po řádcích podle polohy slov (jako pdfplumber extract_text).
+    get_text("text") dává každý textový objekt na vlastní řádek, takže popisek
+    a čísla na stejném řádku výkazu by se nikdy nepotkaly.
+    """
+    # slovo = (x0, y0, x1, y1, text, block, line, word)
+    lines: List[list] = []
+    for w in sorted(p.get_text("words"), key=lambda w: (w[1], w[0])):
+        if lines and w[1] - lines[-1][0][1] <= LINE_TOL:
+            lines[-1].append(w)
+        else:
+            lines.append([w])
+    return "\n".join(" ".join(w[4] for w in sorted(line, key=lambda w: w[0])) for line in lines)
+
+def page_table_pymupdf(p, min_cols: int) -> Optional[Table]:
+    """Největší tabulka z jedné PyMuPDF stránky (nebo None)."""
+    page_tables: List[Table] = []
+
+    # 1) explicitní tabulky
+    for t in p.find_tables().tables:
+        tbl = table_from_rows(t.extract(), min_cols)
+        if tbl is not None:
+            page_tables.append(tbl)
+
+    # 2) fallback z textu POUZE pokud nic nenašli
+    if not page_tables:
+        tbl = table_from_text(page_text_pymupdf(p), min_cols)
+        if tbl is not None:
+            page_tables.append(tbl)
+
+    # 3) ze stránky vyber největší tabulku
+    if page_tables:
+        return max(page_tables, key=lambda t: len(t) * len(t[0]))
+    return None
+
+# -------- limit na stránku --------
+class PageTimeout(Exception):
+    pass
+
+class PageDeadline:
+    """
+    `with PageDeadline(s) as d:` – po `s` sekundách vyhodí PageTimeout (SIGALRM)
+    a nastaví d.expired; to platí i když výjimku knihovna sama spolkne
+    (PyMuPDF find_tables ji jen vypíše). Funguje jen v hlavním vlákně procesu;
+    stránky se parsují jen ve workerech poolu, kde úloha v hlavním vlákně běží.
+    Jinde (vlákno serveru) běží bez limitu.
+    """
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expired = False
+        self.armed = (
+            seconds > 0 and hasattr(signal, "setitimer")
+            and threading.current_thread() is threading.main_thread()
+        )
+
+    def _on_alarm(self, signum, frame):
+        self.expired = True
+        raise PageTimeout()
+
+    def __enter__(self):
+        if self.armed:
+            self._prev = signal.signal(signal.SIGALRM, self._on_alarm)
+            signal.setitimer(signal.ITIMER_REAL, self.seconds)
+        return self
+
+    def __exit__(self, *exc):
+        if self.armed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self._prev)
+        return False
+
+def page_table_guarded(page_table, p, page_index: int, min_cols: int) -> PageResult:
+    """page_table(p, min_cols) s PAGE_TIMEOUT; zaseklou stránku přeskočí a zaloguje."""
+    deadline = PageDeadline(PAGE_TIMEOUT)
+    try:
+        with deadline:
+            tbl = page_table(p, min_cols)
+    except Exception:
+        # po vypršení může přijít i jiná chyba z napůl přerušené knihovny
+        if not deadline.expired:
+            raise
+    if deadline.expired:
+        logger.warning("Stránka %d: parsování přesáhlo %ss, přeskakuji.", page_index + 1, PAGE_TIMEOUT)
+        return None, True
+    return tbl, False
+
+def collect_pages(results) -> Extracted:
+    tables: List[Table] = []
+    skipped: List[int] = []
+    for i, (tbl, timed_out) in enumerate(results, start=1):
+        if timed_out:
+            skipped.append(i)
+        elif tbl is not None:
+            tables.append(tbl)
+    return tables, skipped
+
+# -------- parsování v procesech --------
+# Parsování je CPU-bound (drží GIL), proto běží ve sdíleném poolu procesů mimo
+# server. "spawn": fork vícevláknového procesu (uvicorn + threadpool) není bezpečný.
+# Pool vzniká až při prvním použití v serveru, nikdy při importu (ten dělá i worker).
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def _init_worker():
+    # Ctrl+C dostane celá skupina procesů; worker ukončí shutdown_pool z rodiče
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return _pool
+
+def shutdown_pool(only: Optional[ProcessPoolExecutor] = None):
+    """Zavře pool; s `only` jen pokud je to pořád ten (rozbitý) pool, ne už nový."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and (only is None or _pool is only):
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+# od tohoto počtu stránek se PDF rozdělí po stránkách (každý worker si ho otevře
+# znovu); menší PDF zpracuje jeden worker celé najednou
+PARALLEL_MIN_PAGES = 4
+
+# Worker si nechá otevřené poslední PDF: pool.map mu dává stránky stejného
+# souboru, takže otevření (u pdfplumberu parser pdfminer) se zaplatí jednou.
+# Jen jedna položka → paměť i otevřené soubory zůstávají omezené.
+_worker_pdf: Optional[Tuple[tuple, object]] = None
+
+def worker_pdf(opener, src: PdfSource):
+    global _worker_pdf
+    if isinstance(src, bytes):
+        ident = hash(src)
+    else:
+        # cesta k tempfile se může opakovat → identita i podle inode/velikosti/mtime
+        st = os.stat(src)
+        ident = (src, st.st_ino, st.st_size, st.st_mtime_ns)
+    key = (opener.__name__, ident)
+    if _worker_pdf is None or _worker_pdf[0] != key:
+        drop_worker_pdf()
+        _worker_pdf = (key, opener(src))
+    return _worker_pdf[1]
+
+def drop_worker_pdf():
+    global _worker_pdf
+    if _worker_pdf is not None:
+        _worker_pdf[1].close()
+        _worker_pdf = None
+
+def _parse_page_pdfplumber(src: PdfSource, page_index: int, min_cols: int) -> PageResult:
+    p = worker_pdf(open_pdfplumber, src).pages[page_index]
+    try:
+        res = page_table_guarded(page_table_pdfplumber, p, page_index, min_cols)
+    finally:
+        p.close()  # znaky/layout stránky v cache otevřeného PDF nedržet
+    if res[1]:
+        drop_worker_pdf()  # parser přerušený timeoutem znovu nepoužívat
+    return res
+
+def _parse_page_pymupdf(src: PdfSource, page_index: int, min_cols: int) -> PageResult:
+    res = page_table_guarded(page_table_pymupdf, worker_pdf(open_pymupdf, src).load_page(page_index), page_index, min_cols)
+    if res[1]:
+        drop_worker_pdf()
+    return res
+
+def extract_tables_pdfplumber(src: PdfSource, min_cols: int) -> Extracted:
     """
     Z každé PDF stránky vrátí max 1 tabulku (největší nalezenou).
     Fallback z textu spustí jen tehdy, když se nepodaří detekovat "skutečnou" tabulku.
+    Vrací i seznam stránek přeskočených kvůli PAGE_TIMEOUT.
+    Stránky jdou přes _parse_page_pdfplumber jako v paralelní cestě, takže i tady
+    se po timeoutu dokument znovu otevře.
+    """
+    n_pages = len(worker_pdf(open_pdfplumber, src).pages)
+    return collect_pages(_parse_page_pdfplumber(src, i, min_cols) for i in range(n_pages))
+
+def extract_tables_pymupdf(src: PdfSource, min_cols: int) -> Extracted:
+    """
+    Totéž co extract_tables_pdfplumber, jen přes PyMuPDF (find_tables + get_text),
+    které je na textových PDF řádově rychlejší než pdfminer.
+    """
+    n_pages = worker_pdf(open_pymupdf, src).page_count
+    return collect_pages(_parse_page_pymupdf(src, i, min_cols) for i in range(n_pages))
+
+def count_pages(src: PdfSource) -> int:
+    if PDF_BACKEND == "pdfplumber":
+        with open_pdfplumber(src) as pdf:
+            return len(pdf.pages)
+    with open_pymupdf(src) as doc:
+        return doc.page_count
+
+class TooManyPages(ValueError):
+    pass
+
+class ParserCrashed(RuntimeError):
+    pass
+
+def extract_tables(src: PdfSource, min_cols: int) -> Extracted:
+    """
+    Parsuje v poolu procesů: malé PDF jako jednu úlohu, větší po stránkách (stránky jsou
+    nezávislé, pořadí výsledků zůstává). Blokuje – z async handleru přes run_in_executor.
+    """
+    if PDF_BACKEND == "pdfplumber":
+        extract_all, parse_page = extract_tables_pdfplumber, _parse_page_pdfplumber
+    else:
+        extract_all, parse_page = extract_tables_pymupdf, _parse_page_pymupdf
+
+    n_pages = count_pages(src)
+    if n_pages > MAX_PAGES:
+        raise TooManyPages(f"PDF má {n_pages} stránek, limit je {MAX_PAGES}.")
+    pool = get_pool()
+    try:
+        if n_pages < PARALLEL_MIN_PAGES:
+            return pool.submit(extract_all, src, min_cols).result()
+        return collect_pages(pool.map(parse_page, repeat(src), range(n_pages), repeat(min_cols)))
+    except BrokenProcessPool:
+        # worker zemřel (segfault v MuPDF/pdfminer, OOM kill) → pool je rozbitý
+        # natrvalo; zahodit ho, další požadavek dostane nový. Znovu to nezkoušíme,
+        # stejné PDF by nejspíš shodilo i nový pool.
+        shutdown_pool(only=pool)
+        raise ParserCrashed("Parser PDF spadl, zkus to prosím znovu.")
+
+# -------- cache podle obsahu PDF --------
+# Relay workflow často posílá stejné PDF znovu (retry, jiné max_sheets);
+# klíč je SHA-256 obsahu, takže nezáleží na tom, jestli přišlo uploadem nebo z URL.
+CACHE_SIZE = 16
+_tables_cache: "OrderedDict[tuple, List[Table]]" = OrderedDict()
+_tables_cache_lock = threading.Lock()
+
+def pdf_digest(src: PdfSource) -> bytes:
+    h = hashlib.sha256()
+    if isinstance(src, bytes):
+        h.update(src)
+    else:
+        with open(src, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.digest()
+
+def extract_tables_cached(src: PdfSource, min_cols: int) -> Extracted:
+    """
+    extract_tables s LRU cache na CACHE_SIZE dokumentů. Výsledek s přeskočenými
+    stránkami se neukládá (timeout závisí na zátěži). Tabulky z cache se nesmí měnit.
+    """
+    key = (pdf_digest(src), min_cols, PDF_BACKEND)
+    with _tables_cache_lock:
+        tables = _tables_cache.get(key)
+        if tables is not None:
+            _tables_cache.move_to_end(key)
+            return tables, []
+
+    tables, skipped = extract_tables(src, min_cols)
+    if not skipped:
+        with _tables_cache_lock:
+            _tables_cache[key] = tables
+            while len(_tables_cache) > CACHE_SIZE:
+                _tables_cache.popitem(last=False)
+    return tables, skipped
+
+# -------- sestavení XLSX --------
+def build_xlsx(tables: List[Table], skipped: List[int], source_kv: Tuple[str, str],
+               max_sheets: int, include_log: bool) -> str:
+    """
+    Tabulka → list "Tab N" (s hlavičkou, pokud ji první řádek má), volitelně _LOG.
+    Vrací cestu k dočasnému .xlsx (viz save_xlsx_tempfile). WolfXL workbook nejde
+    předat jinému vláknu, proto vzniká i ukládá se tady v jednom volání.
+    """
+    # write_only: řádky se streamují do souboru, žádné Cell objekty v paměti
+    wb = Workbook(write_only=True)
+
+    # záporné max_sheets = žádný list (jako dřív `count >= max_sheets`), ne tables[:-1]
+    for idx, rows in enumerate(tables[:max(max_sheets, 0)], start=1):
+        header = [f"col{j+1}" for j in range(len(rows[0]))]
+        first = rows[0]
+        if looks_like_header(first):
+            header = [norm_text(x) or f"col{j+1}" for j, x in enumerate(first)]
+            rows = rows[1:]
+
+        ws = wb.create_sheet(f"Tab {idx}")
+        ws.append(header)
+        for r in rows:
+            ws.append(r)
+
+    if include_log:
+        log = wb.create_sheet("_LOG")
+        log.append(list(source_kv))
+        log.append(["Počet stránek/tabulek", len(tables)])
+        log.append(["Pozn.", "Každá stránka → 1 hlavní tabulka (největší)."])
+        if skipped:
+            log.append(["Přeskočené stránky (timeout)", ", ".join(map(str, skipped))])
+
+    return save_xlsx_tempfile(wb)
+
+def xlsx_response(xlsx_path: str, filename: str) -> FileResponse:
     """
-    tables: List[pd.DataFrame] = []
-    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-        for p in pdf.pages:
-            page_tables: List[pd.DataFrame] = []
-
-            # 1) explicitní tabulky
-            raw_tbls = p.extract_tables() or []
-            for t in raw_tbls:
-                rows = [[nz(c) for c in (trow or [])] for trow in t or []]
-                if not rows:
-                    continue
-                width = max(len(r) for r in rows)
-                rows = [r + [""] * (width - len(r)) for r in rows]
-                df = pd.DataFrame(rows)
-                if df.shape[1] >= min_cols and df.shape[0] >= 2:
-                    page_tables.append(df)
-
-            # 2) fallback z textu POUZE pokud nic nenašli
-            if not page_tables:
-                txt = p.extract_text() or ""
-                if txt:
-                    lines = [l for l in txt.splitlines() if l.strip()]
-                    rec = []
-                    for ln in lines:
-                        nums = list(NUM_RX.finditer(ln))
-                        if not nums:
-                            continue
-                        values = []
-                        for m in reversed(nums):
-                            tok = m.group(0)
-                            if m.end() >= len(ln) or ln[m.end()] == " ":
-                                values.insert(0, tok)
-                            else:
-                                break
-                        if not values:
-                            continue
-                        label = re.sub(
-                            r"\s+\(?-?\d+(?:\s\d{3})*\)?(?:\s+\(?-?\d+(?:\s\d{3})*\)?)*\s*$",
-                            "", ln
-                        ).strip()
-                        rec.append([label] + values)
-                    if rec:
-                        width = max(len(r) for r in rec)
-                        rec = [r + [""] * (width - len(r)) for r in rec]
-                        df = pd.DataFrame(rec)
-                        if df.shape[1] >= min_cols and df.shape[0] >= 2:
-                            page_tables.append(df)
-
-            # 3) ze stránky vyber největší tabulku
-            if page_tables:
-                biggest = max(page_tables, key=lambda d: d.shape[0] * d.shape[1])
-                tables.append(biggest)
-
-    return tables
+    Pošle .xlsx ke stažení a po odeslání ho smaže. filename= místo ručního
+    Content-Disposition: Starlette názvy mimo latin-1 (č, ř, ů…) zakóduje jako
+    filename*=utf-8''…. Selže-li už sestavení odpovědi, soubor se smaže hned.
+    """
+    try:
+        return FileResponse(
+            xlsx_path,
+            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            filename=filename,
+            background=BackgroundTask(os.unlink, xlsx_path),
+        )
+    except Exception:
+        os.unlink(xlsx_path)
+        raise
+
+def pdf_too_large() -> HTTPException:
+    return HTTPException(413, f"PDF je větší než limit {MAX_PDF_BYTES / (1024 * 1024):.3g} MB.")
 
 # -------- API basics --------
 @app.get("/")
@@ -114,54 +625,39 @@ async def pdf_to_struct_xlsx(
     max_sheets: int = Form(20),
     include_log: bool = Form(True),
 ):
-    if not file.filename.lower().endswith(".pdf"):
-        raise HTTPException(400, "Nahraj PDF soubor.")
-
-    pdf_bytes = await file.read()
-
-    try:
-        tables = extract_tables_pdfplumber(pdf_bytes, min_cols)
-    except Exception as e:
-        raise HTTPException(500, f"Chyba při parsování PDF: {e}")
+    # typ podle obsahu, ne podle přípony: PDF vždy začíná "%PDF"
+    head = await file.read(4)
+    if head != b"%PDF":
+        raise HTTPException(415, "Nahraný soubor nevypadá jako PDF.")
+
+    loop = asyncio.get_running_loop()
+    # upload jde po kouscích rovnou na disk, do paměti se celé PDF nenačítá
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+        tmp.write(head)
+        while chunk := await file.read(1024 * 1024):
+            tmp.write(chunk)
+            if tmp.tell() > MAX_PDF_BYTES:
+                raise pdf_too_large()
+        tmp.flush()
+        try:
+            # parsování i hash PDF mimo event loop (vlákno → pool procesů)
+            tables, skipped = await loop.run_in_executor(None, extract_tables_cached, tmp.name, min_cols)
+        except TooManyPages as e:
+            raise HTTPException(422, str(e))
+        except ParserCrashed as e:
+            raise HTTPException(503, str(e))
+        except Exception as e:
+            raise HTTPException(500, f"Chyba při parsování PDF: {e}")
 
     if not tables:
         raise HTTPException(422, "V dokumentu jsem nenašel žádné tabulky.")
 
-    wb = Workbook()
-    wb.remove(wb.active)
-
-    count = 0
-    for idx, df in enumerate(tables, start=1):
-        if count >= max_sheets:
-            break
-        df0 = df.fillna("")
-        header = [f"col{j+1}" for j in range(df0.shape[1])]
-        df0.columns = header
-        first = df0.iloc[0].tolist()
-        if any(re.search(r"[A-Za-z]", nz(x)) for x in first) and not all(NUM_RX.fullmatch(nz(x) or "") for x in first[1:]):
-            df0.columns = [norm_text(nz(x)) or f"col{j+1}" for j, x in enumerate(first)]
-            df0 = df0.iloc[1:]
-
-        ws = wb.create_sheet(f"Tab {idx}")
-        for r in dataframe_to_rows(df0, index=False, header=True):
-            ws.append(r)
-        count += 1
-
-    if include_log:
-        log = wb.create_sheet("_LOG")
-        log.append(["Zdroj PDF", file.filename])
-        log.append(["Počet stránek/tabulek", len(tables)])
-        log.append(["Pozn.", "Každá stránka → 1 hlavní tabulka (největší)."])
-
-    out = io.BytesIO()
-    wb.save(out)
-    out.seek(0)
     base = os.path.splitext(os.path.basename(file.filename))[0]
-    return StreamingResponse(
-        out,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename={base}_tables.xlsx"}
+    # sestavení i uložení workbooku mimo event loop (celé v jednom vlákně)
+    xlsx_path = await loop.run_in_executor(
+        None, build_xlsx, tables, skipped, ("Zdroj PDF", file.filename), max_sheets, include_log
     )
+    return xlsx_response(xlsx_path, f"{base}_tables.xlsx")
 
 # -------- API: z URL (Relay-friendly) --------
 @app.post("/pdf_from_url_to_struct_xlsx")
@@ -174,66 +670,54 @@ async def pdf_from_url_to_struct_xlsx(
     # 1) normalizace Google Drive URL na přímé stažení
     def normalize_gdrive(u: str) -> str:
         u = u.strip()
-        m = re.match(r"https?://drive\.google\.com/file/d/([^/]+)/", u)
+        m = GDRIVE_RX.match(u)
         if m:
             return f"https://drive.google.com/uc?export=download&id={m.group(1)}"
         return u
 
     url = normalize_gdrive(file_url)
-
-    # 2) stáhni PDF
-    try:
-        r = requests.get(url, timeout=30)
-        r.raise_for_status()
-    except Exception as e:
-        raise HTTPException(400, f"Nepodařilo se stáhnout PDF z URL: {e}")
-
-    ctype = (r.headers.get("Content-Type") or "").lower()
-    if "pdf" not in ctype and not r.content.startswith(b"%PDF"):
-        raise HTTPException(415, "Stažený obsah nevypadá jako PDF.")
-
-    pdf_bytes = r.content
-
-    # 3) extrakce stejnou funkcí
-    try:
-        tables = extract_tables_pdfplumber(pdf_bytes, min_cols)
-    except Exception as e:
-        raise HTTPException(500, f"Chyba při parsování PDF: {e}")
+    loop = asyncio.get_running_loop()
+
+    # 2) stáhni PDF po kouscích rovnou na disk; že nejde o PDF, pozná už z 1. kousku
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+        try:
+            async with HTTP.stream("GET", url) as r:
+                r.raise_for_status()
+                ctype = (r.headers.get("Content-Type") or "").lower()
+                clen = r.headers.get("Content-Length")
+                if clen and clen.isdigit() and int(clen) > MAX_PDF_BYTES:
+                    raise pdf_too_large()
+                chunks = r.aiter_bytes(65536)
+                first = await anext(chunks, b"")
+                if "pdf" not in ctype and not first.startswith(b"%PDF"):
+                    raise HTTPException(415, "Stažený obsah nevypadá jako PDF.")
+                tmp.write(first)
+                async for chunk in chunks:
+                    tmp.write(chunk)
+                    # Content-Length chybí nebo lže → hlídat i skutečně stažené
+                    if tmp.tell() > MAX_PDF_BYTES:
+                        raise pdf_too_large()
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(400, f"Nepodařilo se stáhnout PDF z URL: {e}")
+        tmp.flush()
+
+        # 3) extrakce stejnou funkcí
+        try:
+            # parsování i hash PDF mimo event loop (vlákno → pool procesů)
+            tables, skipped = await loop.run_in_executor(None, extract_tables_cached, tmp.name, min_cols)
+        except TooManyPages as e:
+            raise HTTPException(422, str(e))
+        except ParserCrashed as e:
+            raise HTTPException(503, str(e))
+        except Exception as e:
+            raise HTTPException(500, f"Chyba při parsování PDF: {e}")
 
     if not tables:
         raise HTTPException(422, "V dokumentu jsem nenašel žádné tabulky.")
 
-    wb = Workbook()
-    wb.remove(wb.active)
-
-    count = 0
-    for idx, df in enumerate(tables, start=1):
-        if count >= max_sheets:
-            break
-        df0 = df.fillna("")
-        header = [f"col{j+1}" for j in range(df0.shape[1])]
-        df0.columns = header
-        first = df0.iloc[0].tolist()
-        if any(re.search(r"[A-Za-z]", nz(x)) for x in first) and not all(NUM_RX.fullmatch(nz(x) or "") for x in first[1:]):
-            df0.columns = [norm_text(nz(x)) or f"col{j+1}" for j, x in enumerate(first)]
-            df0 = df0.iloc[1:]
-
-        ws = wb.create_sheet(f"Tab {idx}")
-        for rrow in dataframe_to_rows(df0, index=False, header=True):
-            ws.append(rrow)
-        count += 1
-
-    if include_log:
-        log = wb.create_sheet("_LOG")
-        log.append(["Zdroj URL", file_url])
-        log.append(["Počet stránek/tabulek", len(tables)])
-        log.append(["Pozn.", "Každá stránka → 1 hlavní tabulka (největší)."])
-
-    out = io.BytesIO()
-    wb.save(out)
-    out.seek(0)
-    return StreamingResponse(
-        out,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=tables.xlsx"}
+    xlsx_path = await loop.run_in_executor(
+        None, build_xlsx, tables, skipped, ("Zdroj URL", file_url), max_sheets, include_log
     )
+    return xlsx_response(xlsx_path, "tables.xlsx")